@@ -2,6 +2,12 @@
 
 import argparse
 import asyncio
+import bisect
+import gzip
+import json
+import os
+import queue
+import re
 from re import DEBUG
 import selectors
 import socket
@@ -9,6 +15,8 @@ import sys
 import threading
 import time
 import selectors
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict, deque
 from datetime import datetime
 from pathlib import Path
 from threading import Lock
@@ -23,6 +31,7 @@ from prompt_toolkit.contrib.regular_languages.completion import \
     GrammarCompleter
 from prompt_toolkit.contrib.regular_languages.lexer import GrammarLexer
 from prompt_toolkit.document import Document
+from prompt_toolkit.history import History, ThreadedHistory
 from prompt_toolkit.key_binding import KeyBindings
 from prompt_toolkit.layout.containers import (Float, FloatContainer, HSplit,
                                               Window)
@@ -35,6 +44,10 @@ from prompt_toolkit.output import ColorDepth
 from prompt_toolkit.styles import Style
 from prompt_toolkit.widgets import SearchToolbar, TextArea
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 selector = selectors.SelectSelector()
 loop = asyncio.SelectorEventLoop(selector)
@@ -42,9 +55,72 @@ asyncio.set_event_loop(loop)
 
 RECV_BUFFER_SIZE = 4096
 SCRIPT_HOME = Path.home() / 'mpdscripts'
+HISTORY_HOME = (Path(os.environ['XDG_STATE_HOME']) / 'mpdshell'
+                if 'XDG_STATE_HOME' in os.environ else SCRIPT_HOME / 'history')
+HISTORY_MAX_BYTES = 4 * 1024 * 1024
+HISTORY_READ_BLOCK = 64 * 1024
+HISTORY_SEARCH_LIMIT = 20
+LOG_MAX_BYTES = 64 * 1024 * 1024
+LOG_BACKUPS = 5
+LOG_QUEUE_MAX_BYTES = 64 * 1024 * 1024
+CACHE_MAX_BYTES = 8 * 1024 * 1024
+BULK_BATCH_SIZE = 256
+BULK_WINDOW = 4
+EXPORT_WINDOW = 1000
+BULK_ERROR_LIMIT = 20
+PROGRESS_INTERVAL = 2.0
+CHECKPOINT_INTERVAL = 1.0
 DEBUGAPP = False
 NOECHO = False
 APP = None
+HISTORY = None
+TEE = None
+BULKJOB = None
+WATCHER = None
+ACK_ERROR_ARG = 2
+ACK_LINE = re.compile(r'^ACK \[(\d+)@(\d+)\]')
+REPLY_END = re.compile(rb'^(?:OK|ACK [^\n]*|binary: (\d+))\n', re.MULTILINE)
+
+# Read-only commands whose replies can be cached, mapped to the idle
+# subsystems that invalidate them. An empty tuple means only a local
+# mutation (see cache_mutations) can change the reply.
+cache_subsystems = {
+    "commands": (),
+    "notcommands": (),
+    "decoders": (),
+    "urlhandlers": (),
+    "tagtypes": (),
+    "outputs": ("output",),
+    "listplaylists": ("stored_playlist",),
+    "listplaylist": ("stored_playlist",),
+    "listplaylistinfo": ("stored_playlist", "database"),
+    "lsinfo": ("database", "stored_playlist"),
+    "listmounts": ("mount",),
+    "listneighbors": ("neighbor",)
+}
+
+# Commands sent from this shell that change cached replies before the idle
+# event about them arrives. None invalidates everything.
+cache_mutations = {
+    "password": None,
+    "tagtypes": None,
+    "partition": None,
+    "save": ("stored_playlist",),
+    "rm": ("stored_playlist",),
+    "rename": ("stored_playlist",),
+    "playlistadd": ("stored_playlist",),
+    "playlistclear": ("stored_playlist",),
+    "playlistdelete": ("stored_playlist",),
+    "playlistmove": ("stored_playlist",),
+    "searchaddpl": ("stored_playlist",),
+    "enableoutput": ("output",),
+    "disableoutput": ("output",),
+    "toggleoutput": ("output",),
+    "outputset": ("output",),
+    "moveoutput": ("output",),
+    "mount": ("mount", "database"),
+    "unmount": ("mount", "database")
+}
 
 mpdcmds = [
     "add",
@@ -158,7 +234,13 @@ internalcmds = {
     "scripts": lambda s, x: listscripts(s, x),
     "help": lambda s, x: apphelp(s, x),
     "mpchelp": lambda s, x: mpchelp(s, x),
-    "reset": lambda s, x: resetterm(s,x)
+    "reset": lambda s, x: resetterm(s,x),
+    "history": lambda s, x: searchhistory(s, x),
+    "tee": lambda s, x: teeoutput(s, x),
+    "cache": lambda s, x: cachestats(s, x),
+    "import": lambda s, x: importplaylist(s, x),
+    "export": lambda s, x: exportplaylist(s, x),
+    "msg": lambda s, x: messaging(s, x)
 }
 
 
@@ -191,14 +273,850 @@ class RepeatedTimer(object):
         self.is_running = False
 
 
+class PersistentHistory(History):
+    """
+    Append-only command history with one file per server.
+
+    Entries are stored one per line. Loading reads the file backwards in
+    blocks, so the most recent commands are available right away while the
+    rest is still being read. Once the file grows past ``max_bytes`` it gets
+    compacted down to the newest unique entries that fit into half of it.
+
+    password commands are never written and the files are only readable by
+    their owner.
+    """
+
+    def __init__(self, path: Path, max_bytes: int = HISTORY_MAX_BYTES):
+        super().__init__()
+        self.path = path
+        self.max_bytes = max_bytes
+        self._file_lock = Lock()
+        self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        self._size = 0
+        if self.path.exists():
+            os.chmod(self.path, 0o600)
+            self._size = self.path.stat().st_size
+
+    def load_history_strings(self):
+        with self._file_lock:
+            if self._size > self.max_bytes:
+                self._compact()
+        seen = set()
+        for line in self._read_reversed():
+            if line not in seen and not self._secret(line):
+                seen.add(line)
+                yield line
+
+    def store_string(self, string: str):
+        line = string.replace('\n', ' ').strip()
+        if not line or self._secret(line):
+            return
+        data = bytes(line + '\n', 'utf-8')
+        with self._file_lock:
+            with open(self._private(self.path, os.O_APPEND), 'ab') as historyfile:
+                historyfile.write(data)
+            self._size += len(data)
+            if self._size > self.max_bytes:
+                self._compact()
+
+    @staticmethod
+    def _secret(line: str) -> bool:
+        return line.split(' ', 1)[0] == 'password'
+
+    @staticmethod
+    def _private(path: Path, flags: int) -> int:
+        return os.open(path, os.O_WRONLY | os.O_CREAT | flags, 0o600)
+
+    def _read_reversed(self):
+        if not self.path.exists():
+            return
+        with open(self.path, 'rb') as historyfile:
+            historyfile.seek(0, os.SEEK_END)
+            position = historyfile.tell()
+            remainder = b''
+            while position > 0:
+                step = min(HISTORY_READ_BLOCK, position)
+                position -= step
+                historyfile.seek(position)
+                lines = (historyfile.read(step) + remainder).split(b'\n')
+                remainder = lines.pop(0)
+                for line in reversed(lines):
+                    if line:
+                        yield str(line, 'utf-8', errors='replace')
+            if remainder:
+                yield str(remainder, 'utf-8', errors='replace')
+
+    def _compact(self):
+        budget = self.max_bytes // 2
+        keep = []
+        seen = set()
+        for line in self._read_reversed():
+            if line in seen or self._secret(line):
+                continue
+            budget -= len(bytes(line, 'utf-8')) + 1
+            if budget < 0:
+                break
+            seen.add(line)
+            keep.append(line)
+        data = bytes(''.join(line + '\n' for line in reversed(keep)), 'utf-8')
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with open(self._private(tmp, os.O_TRUNC), 'wb') as historyfile:
+            historyfile.write(data)
+        os.replace(tmp, self.path)
+        self._size = len(data)
+
+
+def history_path(hostname: str, port: int) -> Path:
+    server = re.sub(r'[^A-Za-z0-9.\-]', '_', hostname)
+    return HISTORY_HOME / f'{server}_{port}.history'
+
+
+def fuzzy_score(pattern: str, text: str):
+    """
+    Returns a sort key if all characters of pattern appear in text in order.
+    Prefix matches rank first, then shorter and earlier spans.
+    """
+    if text.startswith(pattern):
+        return (0, 0, 0)
+    start = -1
+    pos = -1
+    for char in pattern:
+        pos = text.find(char, pos + 1)
+        if pos < 0:
+            return None
+        if start < 0:
+            start = pos
+    return (1, pos - start, start)
+
+
+class ReplyLogger(threading.Thread):
+    """
+    Writes every reply to a log file on a background thread.
+
+    Each entry is a JSON header line with the command, the send and receive
+    timestamps and the payload size, followed by the raw reply bytes.
+    Files ending in ``.gz`` or ``.zst`` are compressed and the log is rotated
+    to ``<file>.1`` ... ``<file>.<backups>`` once it grows past ``max_bytes``.
+
+    At most ``LOG_QUEUE_MAX_BYTES`` wait for the disk. While the disk is
+    that far behind new replies are dropped and counted; a single reply
+    larger than that is still taken when nothing else is waiting. The first
+    drop and write errors are reported through ``onerror``, a write error
+    stops the logger and everything after that is dropped.
+    """
+
+    def __init__(self, path: Path, max_bytes: int = LOG_MAX_BYTES, backups: int = LOG_BACKUPS,
+                 onerror=None):
+        super().__init__(daemon=True)
+        if path.suffix == '.zst' and zstandard is None:
+            raise RuntimeError("zstd compressed logs need the 'zstandard' package")
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.onerror = onerror
+        self.failed = False
+        self.dropped = 0
+        self._dropnotice = False
+        self._queue = queue.SimpleQueue()
+        self._queued = 0
+        self._queue_lock = Lock()
+        self._raw = None
+        self._file = None
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._open()
+        self.start()
+
+    def log(self, command: str, sent: float, received: float, data: bytes):
+        # Never blocks, the socket thread only hands the reply over.
+        with self._queue_lock:
+            behind = self._queued > 0 and self._queued + len(data) > LOG_QUEUE_MAX_BYTES
+            if self.failed or behind:
+                self.dropped += 1
+                return
+            self._queued += len(data)
+        self._queue.put((command, sent, received, data))
+
+    def stop(self):
+        self._queue.put(None)
+        self.join()
+
+    def run(self):
+        try:
+            while True:
+                entry = self._queue.get()
+                if entry is None:
+                    break
+                with self._queue_lock:
+                    self._queued -= len(entry[3])
+                self._write(*entry)
+                if self.dropped and not self._dropnotice:
+                    self._dropnotice = True
+                    if self.onerror is not None:
+                        self.onerror(f'"{self.path}" can\'t keep up, replies are being dropped')
+            self._close()
+        except (OSError, ValueError) as ex:
+            with self._queue_lock:
+                self.failed = True
+            try:
+                self._close()
+            except (OSError, ValueError):
+                pass
+            if self.onerror is not None:
+                self.onerror(f'Stopped writing replies to "{self.path}": {ex}')
+
+    def _write(self, command, sent, received, data):
+        header = {
+            "command": command,
+            "sent": datetime.fromtimestamp(sent).isoformat() if sent else None,
+            "received": datetime.fromtimestamp(received).isoformat(),
+            "size": len(data)
+        }
+        self._file.write(bytes(json.dumps(header) + '\n', 'utf-8') + data + b'\n')
+        if self._raw.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _open(self):
+        self._raw = open(self.path, 'ab')
+        if self.path.suffix == '.gz':
+            # Level 9 is too slow for the only writer thread.
+            self._file = gzip.GzipFile(fileobj=self._raw, mode='ab', compresslevel=6)
+        elif self.path.suffix == '.zst':
+            self._file = zstandard.ZstdCompressor().stream_writer(self._raw, closefd=False)
+        else:
+            self._file = self._raw
+
+    def _close(self):
+        if self._file is not self._raw:
+            self._file.close()
+        self._raw.close()
+
+    def _rotate(self):
+        self._close()
+        for i in range(self.backups - 1, 0, -1):
+            older = self.path.with_name(f'{self.path.name}.{i}')
+            if older.exists():
+                os.replace(older, self.path.with_name(f'{self.path.name}.{i + 1}'))
+        if self.backups > 0:
+            os.replace(self.path, self.path.with_name(f'{self.path.name}.1'))
+        else:
+            self.path.unlink()
+        self._open()
+
+
+class MPDError(Exception):
+    """
+    The server answered with ACK. code is the MPD error number and index
+    the position of the failed command inside a command list.
+    """
+
+    def __init__(self, line: str):
+        super().__init__(line)
+        match = ACK_LINE.match(line)
+        self.code = int(match.group(1)) if match else None
+        self.index = int(match.group(2)) if match else 0
+
+
+def quote(arg: str) -> str:
+    escaped = arg.replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{escaped}"'
+
+
+def split_commands(message: str) -> List[str]:
+    """
+    Splits a message into the units the server answers with one reply each.
+    Command lists are one unit, close and noidle don't get a reply of their own.
+    """
+    units = []
+    current = None
+    for line in message.split('\n'):
+        line = line.strip()
+        if current is not None:
+            current.append(line)
+            if line == 'command_list_end':
+                units.append('\n'.join(current))
+                current = None
+        elif line in ('command_list_begin', 'command_list_ok_begin'):
+            current = [line]
+        elif line not in ('close', 'noidle'):
+            # Blank lines are answered with "No command given".
+            units.append(line)
+    return units
+
+
+class MPDConnection(object):
+    """
+    Blocking connection for background workers. The shell's own socket is
+    never used for them, so they can't interleave with the user's commands.
+    """
+
+    def __init__(self, hostname: str, port: int, secret: str = None):
+        self.socket = socket.create_connection((hostname, port))
+        self._reader = self.socket.makefile('rb')
+        self.initmsg = self._readline()
+        self._write_lock = Lock()
+        if secret is not None:
+            self.command(f'password {quote(secret)}')
+
+    def write(self, message: str):
+        with self._write_lock:
+            self.socket.sendall(bytes(message + '\n', 'utf-8'))
+
+    def read_reply(self) -> List[str]:
+        lines = []
+        while True:
+            line = self._readline()
+            if line == 'OK':
+                return lines
+            if line.startswith('ACK '):
+                raise MPDError(line)
+            lines.append(line)
+
+    def command(self, message: str) -> List[str]:
+        self.write(message)
+        return self.read_reply()
+
+    def close(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+    def _readline(self) -> str:
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by remote")
+        return str(line, 'utf-8').rstrip('\n')
+
+
+class IdleWatcher(threading.Thread):
+    """
+    Waits in idle on its own connection and reports the changed subsystems
+    to onchange. ondisconnect is called once the connection is gone.
+
+    Channel subscriptions live on this connection as well. Messages are read
+    as soon as idle reports them and handed to onmessage. Commands for this
+    connection go through request(), which interrupts idle with noidle.
+    """
+
+    def __init__(self, hostname: str, port: int, secret: str, onchange, ondisconnect=None):
+        super().__init__(daemon=True)
+        self.connection = MPDConnection(hostname, port, secret)
+        self.onchange = onchange
+        self.ondisconnect = ondisconnect
+        self.onmessage = None
+        self._channels = set()
+        self._requests = deque()
+        self._idle_lock = Lock()
+        self._idling = False
+        self._stopped = False
+        self.start()
+
+    def channels(self) -> List[str]:
+        with self._idle_lock:
+            return sorted(self._channels)
+
+    def subscribe(self, channel: str, callback=None):
+        self.request(f'subscribe {quote(channel)}', self._track(channel, self._channels.add, callback))
+
+    def unsubscribe(self, channel: str, callback=None):
+        self.request(f'unsubscribe {quote(channel)}', self._track(channel, self._channels.discard, callback))
+
+    def _track(self, channel: str, update, callback):
+        def done(reply):
+            if not isinstance(reply, MPDError):
+                with self._idle_lock:
+                    update(channel)
+            if callback is not None:
+                callback(reply)
+        return done
+
+    def request(self, message: str, callback=None):
+        """
+        Runs message on the watcher connection. callback gets the reply lines
+        or the MPDError.
+        """
+        with self._idle_lock:
+            self._requests.append((message, callback))
+            if self._idling:
+                self._idling = False
+                self.connection.write('noidle')
+
+    def run(self):
+        try:
+            while not self._stopped:
+                self._process_requests()
+                with self._idle_lock:
+                    if self._requests:
+                        continue
+                    self._idling = True
+                    self.connection.write('idle')
+                lines = self.connection.read_reply()
+                with self._idle_lock:
+                    self._idling = False
+                changed = [l.split(': ', 1)[1] for l in lines if l.startswith('changed: ')]
+                if 'message' in changed:
+                    self._readmessages()
+                if changed:
+                    self.onchange(changed)
+        except (OSError, MPDError):
+            pass
+        finally:
+            if self.ondisconnect is not None:
+                self.ondisconnect()
+
+    def _process_requests(self):
+        while True:
+            with self._idle_lock:
+                if not self._requests:
+                    return
+                message, callback = self._requests.popleft()
+            try:
+                reply = self.connection.command(message)
+            except MPDError as ex:
+                reply = ex
+            if callback is not None:
+                callback(reply)
+
+    def _readmessages(self):
+        channel = None
+        for line in self.connection.command('readmessages'):
+            key, _, value = line.partition(': ')
+            if key == 'channel':
+                channel = value
+            elif key == 'message' and self.onmessage is not None:
+                self.onmessage(channel, value)
+
+    def stop(self):
+        self._stopped = True
+        self.connection.close()
+
+
+class ReplyCache(object):
+    """
+    LRU cache for replies of the commands in cache_subsystems.
+
+    Entries are dropped when an idle event of one of their subsystems
+    arrives or a command from cache_mutations is sent. The size is bounded
+    by the bytes of the stored replies.
+    """
+
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.enabled = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+
+    @staticmethod
+    def key(message: str):
+        cmd, _, params = message.strip().partition(' ')
+        if '\n' in message or cmd not in cache_subsystems:
+            return None
+        if cmd == 'tagtypes' and params:
+            return None
+        return f'{cmd} {params.strip()}'.strip()
+
+    def get(self, key: str) -> str:
+        with self._lock:
+            reply = self._entries.get(key)
+            if reply is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return reply
+
+    def put(self, key: str, reply: str, generation: int):
+        size = len(reply)
+        with self._lock:
+            # Something was invalidated while the reply was on its way.
+            if not self.enabled or generation != self.generation or size > self.max_bytes:
+                return
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key))
+            self._entries[key] = reply
+            self._size += size
+            while self._size > self.max_bytes:
+                _key, old = self._entries.popitem(last=False)
+                self._size -= len(old)
+                self.evictions += 1
+
+    def invalidate(self, subsystems):
+        with self._lock:
+            self.generation += 1
+            for key in list(self._entries.keys()):
+                if subsystems is None or set(cache_subsystems[key.split(' ', 1)[0]]) & set(subsystems):
+                    self._size -= len(self._entries.pop(key))
+                    self.invalidations += 1
+
+    def invalidate_command(self, message: str):
+        for unit in split_commands(message):
+            for line in unit.split('\n'):
+                cmd, _, params = line.partition(' ')
+                if cmd in cache_mutations and (cmd != 'tagtypes' or params.strip()):
+                    self.invalidate(cache_mutations[cmd])
+
+    def disable(self):
+        with self._lock:
+            self.enabled = False
+        self.invalidate(None)
+
+    def size(self) -> int:
+        return self._size
+
+    def entries(self) -> int:
+        return len(self._entries)
+
+
+def checkpoint_path(path: Path) -> Path:
+    return path.with_name(path.name + '.checkpoint')
+
+
+def load_checkpoint(path: Path) -> dict:
+    try:
+        with open(checkpoint_path(path)) as checkpoint:
+            return json.load(checkpoint)
+    except (OSError, ValueError):
+        return None
+
+
+def save_checkpoint(path: Path, state: dict):
+    target = checkpoint_path(path)
+    tmp = target.with_name(target.name + '.tmp')
+    with open(tmp, 'w') as checkpoint:
+        json.dump(state, checkpoint)
+    os.replace(tmp, target)
+
+
+def remove_checkpoint(path: Path):
+    try:
+        checkpoint_path(path).unlink()
+    except FileNotFoundError:
+        pass
+
+
+class BulkJob(threading.Thread, metaclass=ABCMeta):
+    """
+    Base for long running transfers on their own connection. Progress is
+    reported through the shell's echo and checkpointed next to the file so
+    an interrupted run can be resumed. identity is stored with every
+    checkpoint and has to match for a resume.
+    """
+
+    label = 'Bulk job'
+
+    def __init__(self, mpd, path: Path, resume: bool, identity: dict):
+        super().__init__(daemon=True)
+        self.mpd = mpd
+        self.path = path
+        self.identity = identity
+        self.state = load_checkpoint(path) if resume else None
+        if resume and self.state is None:
+            raise RuntimeError(f'No checkpoint found for "{path}"')
+        if self.state is not None and any(self.state.get(k) != v for k, v in identity.items()):
+            raise RuntimeError(f'The checkpoint of "{path}" belongs to a different {self.label.lower()}')
+        self.done = self.state['done'] if self.state else 0
+        self.connection = MPDConnection(mpd.server, mpd.port, mpd.secret)
+        self._stopped = False
+        self._lastprogress = time.time()
+        self._lastcheckpoint = time.time()
+
+    def stop(self):
+        self._stopped = True
+
+    def run(self):
+        try:
+            self.transfer()
+            if self._stopped:
+                self.checkpoint()
+                self.mpd.local_echo(f'{self.label} of "{self.path}" interrupted after {self.done} entries, '
+                                    f'continue with "resume"')
+            else:
+                remove_checkpoint(self.path)
+                self.mpd.local_echo(f'{self.label} of "{self.path}" finished: {self.summary()}')
+        except (OSError, MPDError) as ex:
+            # done only covers settled entries, so resuming from here
+            # doesn't send anything twice.
+            try:
+                self.checkpoint()
+                hint = ', continue with "resume"'
+            except OSError:
+                hint = ''
+            self.mpd.local_echo(f'{self.label} of "{self.path}" aborted after {self.done} entries{hint}: {ex}')
+        finally:
+            self.connection.close()
+
+    def progress(self):
+        now = time.time()
+        if now - self._lastcheckpoint >= CHECKPOINT_INTERVAL:
+            self.checkpoint()
+            self._lastcheckpoint = now
+        if now - self._lastprogress >= PROGRESS_INTERVAL:
+            self.mpd.local_echo(f'{self.label} of "{self.path}": {self.summary()}')
+            self._lastprogress = now
+
+    @abstractmethod
+    def transfer(self):
+        """Runs the transfer until it is done or stop() was called."""
+
+    @abstractmethod
+    def checkpoint(self):
+        """Saves the progress so far with save()."""
+
+    @abstractmethod
+    def summary(self) -> str:
+        """Short progress line for the output view."""
+
+    def save(self, progress: dict):
+        save_checkpoint(self.path, dict(self.identity, **progress))
+
+
+class PlaylistImport(BulkJob):
+    """
+    Adds the entries of a m3u or plain text file to the queue.
+
+    Entries are sent as pipelined command_list_ok_begin batches of addid
+    with at most BULK_WINDOW batches in flight. When an entry fails the
+    server skips the rest of its batch; once all batches in flight are
+    answered that rest is sent again with explicit positions, so the queue
+    keeps the order of the file.
+    """
+
+    label = 'Import'
+
+    def __init__(self, mpd, path: Path, resume: bool):
+        # The source must not have changed since the interrupted run.
+        source = path.stat()
+        super().__init__(mpd, path, resume, {"size": source.st_size, "mtime": source.st_mtime_ns})
+        self.first = self.done
+        self.added = self.state['added'] if self.state else 0
+        self.failed = self.state['failed'] if self.state else 0
+        self.errors = []
+        self._failedindex = []
+        self._base = None
+        self._addedbefore = self.added
+        # added and failed as of done, which is what a resume continues from.
+        self._settled = (self.added, self.failed)
+
+    def transfer(self):
+        status = self.connection.command('status')
+        length = int(next(l.split(': ', 1)[1] for l in status if l.startswith('playlistlength: ')))
+        expected = self.state.get('queue') if self.state else None
+        if expected is not None and expected != length:
+            self.mpd.local_echo(f'The queue has {length} songs instead of {expected} since the last run of '
+                                f'"{self.path}", entries may be missing or added twice')
+        self._base = length
+        inflight = deque()
+        for batch in self._batches():
+            if self._stopped:
+                break
+            self._send(batch)
+            inflight.append(batch)
+            self._drain(inflight, False)
+            self.progress()
+        self._drain(inflight, True)
+        if self.errors:
+            output = f'=== Failed entries of "{self.path}" ===\n'
+            for index, uri, error in self.errors:
+                output += f'   - {index}: {uri} ({error})\n'
+            self.mpd.local_echo(output)
+
+    def checkpoint(self):
+        added, failed = self._settled
+        progress = {"done": self.done, "added": added, "failed": failed}
+        if self._base is not None:
+            progress["queue"] = self._base + self.added - self._addedbefore
+        self.save(progress)
+
+    def summary(self) -> str:
+        return f'{self.done} entries, {self.added} added, {self.failed} failed'
+
+    def _entries(self):
+        with open(self.path, encoding='utf-8-sig', errors='replace') as playlist:
+            for line in playlist:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    yield line
+
+    def _batches(self):
+        batch = []
+        start = self.first
+        for index, uri in enumerate(self._entries()):
+            if index < self.first:
+                continue
+            batch.append(uri)
+            if len(batch) == BULK_BATCH_SIZE:
+                yield (start, batch)
+                start += len(batch)
+                batch = []
+        if batch:
+            yield (start, batch)
+
+    def _send(self, batch, position=None):
+        _start, uris = batch
+        lines = ['command_list_ok_begin']
+        for i, uri in enumerate(uris):
+            if position is None:
+                lines.append(f'addid {quote(uri)}')
+            else:
+                lines.append(f'addid {quote(uri)} {position + i}')
+        lines.append('command_list_end')
+        self.connection.write('\n'.join(lines))
+
+    def _settle(self, batch):
+        """
+        Reads the reply of a batch and returns the entries the server
+        skipped after a failure, if any.
+        """
+        start, uris = batch
+        try:
+            self.connection.read_reply()
+            self.added += len(uris)
+            return None
+        except MPDError as ex:
+            if ex.code is None or ex.index >= len(uris):
+                raise
+            self.added += ex.index
+            self.failed += 1
+            bisect.insort(self._failedindex, start + ex.index)
+            if len(self.errors) < BULK_ERROR_LIMIT:
+                self.errors.append((start + ex.index, uris[ex.index], str(ex)))
+            rest = uris[ex.index + 1:]
+            return (start + ex.index + 1, rest) if rest else None
+
+    def _drain(self, inflight, everything: bool):
+        retries = []
+        end = None
+        while inflight and (everything or retries or len(inflight) >= BULK_WINDOW):
+            batch = inflight.popleft()
+            retry = self._settle(batch)
+            if retry is not None:
+                retries.append(retry)
+            end = batch[0] + len(batch[1])
+            if not retries:
+                self.done = end
+                self._settled = (self.added, self.failed)
+        # Everything before the first retry is answered now, so its position
+        # in the queue is known.
+        while retries:
+            batch = retries.pop(0)
+            placed = batch[0] - self.first - bisect.bisect_left(self._failedindex, batch[0])
+            self._send(batch, self._base + placed)
+            retry = self._settle(batch)
+            if retry is not None:
+                retries.insert(0, retry)
+        if end is not None:
+            self.done = end
+            self._settled = (self.added, self.failed)
+
+
+class PlaylistExport(BulkJob):
+    """
+    Writes a stored playlist to a file, fetched in windows of EXPORT_WINDOW
+    songs with listplaylistinfo. Files ending in .m3u or .m3u8 get extended
+    m3u info lines, anything else one uri per line.
+    """
+
+    label = 'Export'
+
+    def __init__(self, mpd, playlist: str, path: Path, resume: bool):
+        super().__init__(mpd, path, resume, {"playlist": playlist})
+        self.playlist = playlist
+        self.extended = path.suffix in ('.m3u', '.m3u8')
+        self._file = None
+        self._bytes = self.state['bytes'] if self.state else 0
+        if self.state is not None and (not path.exists() or path.stat().st_size < self._bytes):
+            self.connection.close()
+            raise RuntimeError(f'"{path}" is shorter than its checkpoint, not resuming')
+
+    def transfer(self):
+        if self.state is not None:
+            self._file = open(self.path, 'r+b')
+            self._file.truncate(self._bytes)
+            self._file.seek(0, os.SEEK_END)
+        else:
+            self._file = open(self.path, 'wb')
+            if self.extended:
+                self._file.write(b'#EXTM3U\n')
+            self._bytes = self._file.tell()
+        try:
+            self._export()
+        finally:
+            self._file.close()
+
+    def checkpoint(self):
+        if self._file is not None and not self._file.closed:
+            self._file.flush()
+        self.save({"done": self.done, "bytes": self._bytes})
+
+    def summary(self) -> str:
+        return f'{self.done} entries written'
+
+    def _export(self):
+        ranged = False
+        while not self._stopped:
+            try:
+                lines = self.connection.command(
+                    f'listplaylistinfo {quote(self.playlist)} {self.done}:{self.done + EXPORT_WINDOW}')
+            except MPDError as ex:
+                if ex.code != ACK_ERROR_ARG:
+                    raise
+                if ranged:
+                    # Asked for the window right after the last song.
+                    return
+                # Servers before MPD 0.24 don't know ranges here.
+                songs = self._songs(self.connection.command(f'listplaylistinfo {quote(self.playlist)}'))
+                self._write(songs[self.done:])
+                return
+            ranged = True
+            songs = self._songs(lines)
+            self._write(songs)
+            if len(songs) < EXPORT_WINDOW:
+                return
+
+    def _write(self, songs):
+        for song in songs:
+            if self._stopped:
+                return
+            entry = ''
+            if self.extended:
+                duration = int(float(song.get('duration', song.get('Time', -1))))
+                title = song.get('Title', Path(song['file']).stem)
+                if 'Artist' in song:
+                    title = f"{song['Artist']} - {title}"
+                entry += f'#EXTINF:{duration},{title}\n'
+            entry += song['file'] + '\n'
+            self._bytes += self._file.write(bytes(entry, 'utf-8'))
+            self.done += 1
+            self.progress()
+
+    @staticmethod
+    def _songs(lines: List[str]) -> List[dict]:
+        songs = []
+        for line in lines:
+            key, _, value = line.partition(': ')
+            if key == 'file':
+                songs.append({})
+            if songs:
+                songs[-1].setdefault(key, value)
+        return songs
+
+
 class MPDClient(object):
-    def __init__(self, hostname: str, port: int):
+    def __init__(self, hostname: str, port: int, secret: str = None):
         self.selector = selectors.DefaultSelector()
         self._inbuffer = []
         self._outbuffer = []
         self._echobuffer = []
         self.server = hostname
         self.port = port
+        self.secret = secret
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
         self.socket.connect((hostname, port))
@@ -213,6 +1131,11 @@ class MPDClient(object):
             self.socket, selectors.EVENT_READ | selectors.EVENT_WRITE, self.onsocketready)
         self._remote_closed = False
         self.dbg_lastmask = 0x0
+        self._loggers = []
+        self.cache = None
+        self._pending = deque()
+        self._reply = bytearray()
+        self._scanpos = 0
 
     def data_available(self) -> bool:
         with self._io_lock:
@@ -260,6 +1183,14 @@ class MPDClient(object):
                 self.socket.shutdown(socket.SHUT_WR)
                 self.socket.close()
 
+    def add_logger(self, logger: ReplyLogger):
+        with self._io_lock:
+            self._loggers.append(logger)
+
+    def remove_logger(self, logger: ReplyLogger):
+        with self._io_lock:
+            self._loggers.remove(logger)
+
     def ping(self) -> bool:
         self.send('ping')
 
@@ -282,6 +1213,18 @@ class MPDClient(object):
 
     def send(self, message: str):
         with self._io_lock:
+            if self.cache is not None and self.cache.enabled:
+                self.cache.invalidate_command(message)
+                key = self.cache.key(message)
+                # Only answer from the cache if that can't reorder replies.
+                if key is not None and not self._pending and not self._outbuffer:
+                    reply = self.cache.get(key)
+                    if reply is not None:
+                        now = time.time()
+                        for logger in self._loggers:
+                            logger.log(message, now, now, bytes(reply, 'utf-8'))
+                        self._inbuffer.append(reply)
+                        return
             self._outbuffer.append(message)
 
     def onsocketready(self, connection, mask):
@@ -297,6 +1240,7 @@ class MPDClient(object):
             data = connection.recv(RECV_BUFFER_SIZE)
             if data:
                 chunks.append(data)
+                self._collect(data, time.time())
         self._inbuffer.append(str(b''.join(chunks), 'utf-8'))
 
     def _transmit(self, connection):
@@ -305,6 +1249,50 @@ class MPDClient(object):
                 msg = self._outbuffer.pop()
                 command = str(msg + '\n')
                 connection.sendall(bytes(command, 'utf-8'))
+                sent = time.time()
+                generation = self.cache.generation if self.cache is not None else 0
+                for unit in split_commands(msg):
+                    key = self.cache.key(unit) if self.cache is not None else None
+                    self._pending.append((unit, sent, key, generation))
+
+    def _collect(self, data: bytes, received: float):
+        """
+        Splits the received bytes into replies, logs each of them with its
+        own command and stores the complete ones of cacheable commands.
+        Replies nobody wants are not kept around.
+        """
+        self._reply += data
+        while self._pending:
+            match = REPLY_END.search(self._reply, self._scanpos)
+            if match is None:
+                unit, sent, key, generation = self._pending[0]
+                if not self._loggers and (key is None or len(self._reply) > self.cache.max_bytes):
+                    self._pending[0] = (unit, sent, None, generation)
+                    cut = min(self._scanpos, len(self._reply))
+                    cut = max(cut, self._reply.rfind(b'\n', cut) + 1)
+                    del self._reply[:cut]
+                    self._scanpos -= cut
+                else:
+                    self._scanpos = max(self._scanpos, self._reply.rfind(b'\n') + 1)
+                return
+            if match.group(1) is not None:
+                # Skip the binary payload and its trailing newline.
+                self._scanpos = match.end() + int(match.group(1)) + 1
+                continue
+            unit, sent, key, generation = self._pending.popleft()
+            reply = bytes(self._reply[:match.end()])
+            for logger in self._loggers:
+                logger.log(unit, sent, received, reply)
+            if key is not None and match.group(0) == b'OK\n':
+                self.cache.put(key, str(reply, 'utf-8', errors='replace'), generation)
+            del self._reply[:match.end()]
+            self._scanpos = 0
+        if self._reply:
+            # Nothing was asked for this, keep it in the log anyway.
+            for logger in self._loggers:
+                logger.log(None, None, received, bytes(self._reply))
+        self._reply.clear()
+        self._scanpos = 0
 
     def local_echo(self, message):
         with self._io_lock:
@@ -320,7 +1308,7 @@ def create_grammar():
     return compile(
         r"""
         (?P<exec>\![a-z]+) |
-        ((?P<exec>\![a-z]+)\s(?P<execparam>[a-zA-Z0-9.\/\\\-\_\s]+)\s*) |
+        ((?P<exec>\![a-z]+)\s(?P<execparam>[^\n]+?)\s*) |
         (?P<func>[a-z]+) |
         ((?P<func>[a-z]+)\s(?P<params>\+?[a-zA-Z0-9.\/\:\\\-\_\s]+)\s*)
         """
@@ -348,6 +1336,143 @@ def resetterm(mpd, _param):
     mpd.local_echo("Terminal reset!")
 
 
+def searchhistory(mpd, param):
+    if HISTORY is None:
+        mpd.local_echo("History is disabled")
+        return
+    pattern = (param or '').strip()
+    matches = []
+    # get_strings() is oldest first, walk it backwards so that recent
+    # entries win ties.
+    for age, entry in enumerate(reversed(HISTORY.get_strings())):
+        score = fuzzy_score(pattern, entry)
+        if score is not None:
+            matches.append((score, age, entry))
+    matches.sort()
+    output = f'=== History matches for "{pattern}" ===\n'
+    for _score, _age, entry in matches[:HISTORY_SEARCH_LIMIT]:
+        output += '   - ' + entry + "\n"
+    output += f'\n----\n=> Total: {len(matches)}'
+    mpd.local_echo(output)
+
+
+def teeoutput(mpd, param):
+    global TEE
+    if TEE is not None:
+        mpd.remove_logger(TEE)
+        TEE.stop()
+        if not TEE.failed:
+            mpd.local_echo(f'Stopped writing replies to "{TEE.path}", {TEE.dropped} dropped')
+        TEE = None
+    if param is None or param.strip() == '':
+        return
+    TEE = ReplyLogger(Path(param.strip()), LOG_MAX_BYTES, onerror=mpd.local_echo)
+    mpd.add_logger(TEE)
+    mpd.local_echo(f'Writing replies to "{TEE.path}"')
+
+
+def cachestats(mpd, param):
+    cache = mpd.cache
+    if cache is None:
+        mpd.local_echo("Reply cache is disabled")
+        return
+    if param is not None and param.strip() == 'clear':
+        cache.invalidate(None)
+        mpd.local_echo("Reply cache cleared")
+        return
+    lookups = cache.hits + cache.misses
+    ratio = cache.hits / lookups * 100 if lookups else 0.0
+    output = '=== Reply cache ===\n'
+    output += f'   active: {cache.enabled}\n'
+    output += f'   entries: {cache.entries()}\n'
+    output += f'   size: {cache.size()} / {cache.max_bytes} bytes\n'
+    output += f'   hits: {cache.hits}\n'
+    output += f'   misses: {cache.misses}\n'
+    output += f'   hit ratio: {ratio:.1f}%\n'
+    output += f'   evictions: {cache.evictions}\n'
+    output += f'   invalidations: {cache.invalidations}'
+    mpd.local_echo(output)
+
+
+def startbulkjob(mpd, create):
+    global BULKJOB
+    if BULKJOB is not None and BULKJOB.is_alive():
+        mpd.local_echo(f'{BULKJOB.label} of "{BULKJOB.path}" is still running: {BULKJOB.summary()}')
+        return
+    BULKJOB = create()
+    BULKJOB.start()
+    mpd.local_echo(f'{BULKJOB.label} of "{BULKJOB.path}" started at entry {BULKJOB.done}')
+
+
+def importplaylist(mpd, param):
+    params = (param or '').split()
+    resume = len(params) > 1 and params[-1] == 'resume'
+    if resume:
+        params.pop()
+    if not params:
+        mpd.local_echo("Usage: !import <file> [resume]")
+        return
+    startbulkjob(mpd, lambda: PlaylistImport(mpd, Path(' '.join(params)), resume))
+
+
+def exportplaylist(mpd, param):
+    params = (param or '').split()
+    resume = len(params) > 2 and params[-1] == 'resume'
+    if resume:
+        params.pop()
+    if len(params) < 2:
+        mpd.local_echo("Usage: !export <playlist> <file> [resume]")
+        return
+    path = Path(params.pop())
+    startbulkjob(mpd, lambda: PlaylistExport(mpd, ' '.join(params), path, resume))
+
+
+def messaging(mpd, param):
+    if WATCHER is None or not WATCHER.is_alive():
+        mpd.local_echo("Messaging is not available without the idle connection")
+        return
+    action, _, rest = (param or '').strip().partition(' ')
+    channels = [c for c in rest.split(' ', 1)[0].split(',') if c]
+
+    def subscribed(channel):
+        def callback(reply):
+            if isinstance(reply, MPDError):
+                mpd.local_echo(f'Can\'t subscribe to "{channel}": {reply}')
+            else:
+                mpd.local_echo(f'Subscribed to "{channel}"')
+        return callback
+
+    def unsubscribed(channel):
+        def callback(reply):
+            if isinstance(reply, MPDError):
+                mpd.local_echo(f'Can\'t unsubscribe from "{channel}": {reply}')
+            else:
+                mpd.local_echo(f'Unsubscribed from "{channel}"')
+        return callback
+
+    if action == '':
+        subscriptions = WATCHER.channels()
+        output = '=== Subscribed channels ===\n'
+        for channel in subscriptions:
+            output += '   - ' + channel + "\n"
+        output += f'\n----\n=> Total: {len(subscriptions)}'
+        mpd.local_echo(output)
+    elif action == 'sub' and channels:
+        for channel in channels:
+            WATCHER.subscribe(channel, subscribed(channel))
+    elif action == 'unsub' and channels:
+        for channel in channels:
+            WATCHER.unsubscribe(channel, unsubscribed(channel))
+    elif action == 'send' and channels and ' ' in rest:
+        text = rest.split(' ', 1)[1].strip()
+        lines = [f'sendmessage {quote(channel)} {quote(text)}' for channel in channels]
+        if len(lines) > 1:
+            lines = ['command_list_begin'] + lines + ['command_list_end']
+        mpd.send('\n'.join(lines))
+    else:
+        mpd.local_echo("Usage: !msg [sub <channels> | unsub <channels> | send <channels> <text>]")
+
+
 def listscripts(mpd, _param):
     output = f'=== Available mpd shell scripts in "{SCRIPT_HOME}" ==='
     files = list(SCRIPT_HOME.glob("*.ncs"))
@@ -420,7 +1545,7 @@ def get_echodbg_prefix(lineno, wrap_count):
 
 
 def main():
-    global DEBUGAPP, NOECHO, APP
+    global DEBUGAPP, NOECHO, APP, HISTORY, LOG_MAX_BYTES, WATCHER
 
     parser = argparse.ArgumentParser()
     parser.add_argument("host", help="The host of your MPD instance")
@@ -436,13 +1561,45 @@ def main():
                         type=bool, default=False, required=False)
     parser.add_argument("-b", "--buffer-size", help="The size of one TCP buffer. A message might get broken into multiple buffer if the size isn't big enough or your network can't support it. For optimal performance choose a size with the power of two. (default: 4096)",
                         type=int, default=4096, required=False)
+    parser.add_argument("--no-history", help="Don't load or save the command history of this server (default: 0)",
+                        action="store_true", default=False, required=False)
+    parser.add_argument("-l", "--log", help="Write every reply to this file. Files ending in .gz or .zst get compressed. Replies are dropped and counted while more than 64 MiB wait for the disk (default: None)",
+                        type=Path, required=False)
+    parser.add_argument("--log-max-size", help="Rotate log and tee files after this many MiB (default: 64)",
+                        type=int, default=64, required=False)
+    parser.add_argument("-c", "--cache-size", help="Memory for cached replies of read-only commands in MiB, 0 turns the cache off (default: 8)",
+                        type=int, default=8, required=False)
 
     args = parser.parse_args()
     DEBUGAPP = args.debug
+    LOG_MAX_BYTES = args.log_max_size * 1024 * 1024
     alive_tick = args.alive_tick
     port = args.port
     print(f"Connecting to {args.host}@{port}...")
-    mpd = MPDClient(args.host, port)
+    mpd = MPDClient(args.host, port, args.secret)
+
+    logger = None
+    if args.log is not None:
+        logger = ReplyLogger(args.log, LOG_MAX_BYTES, onerror=mpd.local_echo)
+        mpd.add_logger(logger)
+
+    if args.cache_size > 0:
+        mpd.cache = ReplyCache(args.cache_size * 1024 * 1024)
+        mpd.cache.enabled = True
+
+    def onidlechange(changed):
+        if mpd.cache is not None:
+            mpd.cache.invalidate(changed)
+
+    def onidlelost():
+        if mpd.cache is not None:
+            mpd.cache.disable()
+
+    try:
+        WATCHER = IdleWatcher(args.host, port, args.secret, onidlechange, onidlelost)
+    except (OSError, MPDError) as ex:
+        onidlelost()
+        print(f"Reply cache and messaging disabled, can't watch for changes: {ex}")
 
     grammar = create_grammar()
     intro_text = HTML(f"Connected to: <c1>{mpd.server}@{mpd.port}</c1> ❯ <c2>{mpd.initmsg}</c2>")
@@ -473,6 +1630,10 @@ def main():
 
     search_field = SearchToolbar()  # For reverse search.
 
+    if not args.no_history:
+        # ThreadedHistory loads in the background, newest entries first.
+        HISTORY = ThreadedHistory(PersistentHistory(history_path(mpd.server, mpd.port)))
+
     output_field = Buffer()
 
     netdbg_buffer = Buffer()
@@ -483,6 +1644,7 @@ def main():
         height=1,
         lexer=lexer,
         completer=completer,
+        history=HISTORY,
         prompt="❯ ",
         style="class:input",
         multiline=False,
@@ -734,7 +1896,22 @@ def main():
         ####################################
 
     autoping = RepeatedTimer(3.0, lambda x: x.ping_unchecked(), mpd)
-    autopoll = RepeatedTimer(1.0, netpoll)
+    # netpoll runs on the timer and whenever a message arrives.
+    poll_lock = Lock()
+
+    def refresh():
+        with poll_lock:
+            netpoll()
+
+    def showmessage(channel, text):
+        isonow = datetime.now().isoformat(timespec='seconds')
+        mpd.local_echo(f'[{isonow}] <{channel}> {text}')
+        refresh()
+
+    if WATCHER is not None:
+        WATCHER.onmessage = showmessage
+
+    autopoll = RepeatedTimer(1.0, refresh)
     # Run application.
     application = Application(
         layout=Layout(container, focused_element=input_field),
@@ -755,7 +1932,18 @@ def main():
     application.run()
     autoping.stop()
     autopoll.stop()
+    if BULKJOB is not None:
+        BULKJOB.stop()
+        BULKJOB.join()
+    if WATCHER is not None:
+        WATCHER.stop()
     mpd.disconnect()
+    for replylog in (TEE, logger):
+        if replylog is not None:
+            replylog.stop()
+            if replylog.failed or replylog.dropped:
+                state = 'failed, ' if replylog.failed else ''
+                print(f'Log "{replylog.path}": {state}{replylog.dropped} replies dropped')
 
 
 if __name__ == '__main__':